@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+"""
+Near-Duplicate Reel Detector
+Finds reels that were reshared under a different reel_code or as an
+xma_media_share link by comparing perceptual hashes of their thumbnails.
+
+Thumbnails are downloaded once into messages/thumbnails/, hashed (pHash + dHash)
+in a process pool, and the hashes are cached per reel in messages/reel_hashes.json
+so later runs only hash new reels. Near-duplicates are found with multi-index
+hashing: each 64-bit pHash is split into m bands, and by the pigeonhole principle
+any two hashes within k bits are within k // m bits on at least one band. Only
+hashes that collide on a probed band are compared, and the Hamming distances are
+computed with vectorized NumPy ops instead of an all-pairs scan.
+
+Usage:
+  python dedupe_reels.py                   # Report duplicate groups in the thread
+  python dedupe_reels.py --verify          # Check the index against a brute-force scan
+  python dedupe_reels.py --benchmark       # Time the index on 100k synthetic hashes
+"""
+
+import json
+import sys
+import argparse
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta
+from itertools import combinations
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from fetch_and_update import MESSAGES_DIR, THREAD_FILE, reel_key, reel_messages
+
+THUMBNAIL_DIR = MESSAGES_DIR / "thumbnails"
+HASH_CACHE_FILE = MESSAGES_DIR / "reel_hashes.json"
+
+# Max differing bits (out of 64) for two thumbnails to count as the same video
+PHASH_MAX_DISTANCE = 6
+DHASH_MAX_DISTANCE = 10
+
+# Failed thumbnails are retried after RETRY_BACKOFF, doubling per attempt up to
+# MAX_RETRY_BACKOFF. Permanent failures (e.g. an expired signed CDN URL) are only
+# retried once the message has a different thumbnail URL.
+RETRY_BACKOFF = timedelta(days=1)
+MAX_RETRY_BACKOFF = timedelta(days=30)
+RETRYABLE_HTTP_CODES = {408, 429}
+
+# Popcount lookup for NumPy builds without np.bitwise_count (< 2.0)
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Find near-duplicate reels by thumbnail hash")
+    parser.add_argument("--phash-distance", type=int, default=PHASH_MAX_DISTANCE,
+                        help=f"Max pHash Hamming distance (default: {PHASH_MAX_DISTANCE})")
+    parser.add_argument("--dhash-distance", type=int, default=DHASH_MAX_DISTANCE,
+                        help=f"Max dHash Hamming distance (default: {DHASH_MAX_DISTANCE})")
+    parser.add_argument("--verify", action="store_true",
+                        help="Check the duplicate search against a brute-force scan")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Benchmark the duplicate search on synthetic hashes")
+    parser.add_argument("--size", type=int, default=100_000,
+                        help="Number of synthetic hashes for --benchmark (default: 100000)")
+    return parser.parse_args()
+
+
+# --- HASHING ---
+
+def _bits_to_int(bits):
+    value = 0
+    for bit in bits.ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def _dct_matrix(n):
+    """Orthonormal DCT-II basis, so dct2(x) = D @ x @ D.T."""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    d = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    d[0] /= np.sqrt(2.0)
+    return d
+
+
+_DCT_32 = _dct_matrix(32)
+
+
+def phash(image):
+    """64-bit DCT perceptual hash: low frequencies compared to their median."""
+    pixels = np.asarray(image.convert("L").resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    low = (_DCT_32 @ pixels @ _DCT_32.T)[:8, :8]
+    # Skip the DC term when picking the median, it only encodes brightness
+    return _bits_to_int(low > np.median(low.ravel()[1:]))
+
+
+def dhash(image):
+    """64-bit difference hash: horizontal gradient signs on a 9x8 thumbnail."""
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def hash_thumbnail(path):
+    """Returns (phash, dhash) as hex strings, or None if the image is unreadable."""
+    try:
+        with Image.open(path) as image:
+            return f"{phash(image):016x}", f"{dhash(image):016x}"
+    except Exception as e:
+        print(f"⚠️ Could not hash {path}: {e}")
+        return None
+
+
+def download_thumbnail(key, url):
+    """
+    Fetch a thumbnail into THUMBNAIL_DIR, reusing it if already on disk.
+    Returns (path, None) on success, or (None, retryable) on failure.
+    """
+    path = THUMBNAIL_DIR / f"{key}.jpg"
+    if path.exists():
+        return path, None
+    try:
+        with urllib.request.urlopen(url, timeout=20) as resp:
+            path.write_bytes(resp.read())
+        return path, None
+    except urllib.error.HTTPError as e:
+        # 4xx (other than timeouts/rate limits) won't change on retry
+        retryable = e.code in RETRYABLE_HTTP_CODES or e.code >= 500
+        print(f"⚠️ Could not download thumbnail for {key}: {e}")
+        return None, retryable
+    except Exception as e:
+        # Network errors and timeouts
+        print(f"⚠️ Could not download thumbnail for {key}: {e}")
+        return None, True
+
+
+def failure_entry(url, retryable, previous=None):
+    """Cache entry recording a failed thumbnail, with its attempt count."""
+    attempts = previous.get("attempts", 0) + 1 if previous else 1
+    return {
+        "failed_at": datetime.now().isoformat(),
+        "attempts": attempts,
+        "retryable": retryable,
+        "url": url,
+    }
+
+
+def needs_hashing(entry, url):
+    """Whether a reel's cache entry should be (re)computed for this thumbnail URL."""
+    if not entry:
+        return True
+    if "phash" in entry:
+        return False
+    if not entry.get("retryable"):
+        return entry.get("url") != url
+    backoff = min(RETRY_BACKOFF * 2 ** (entry.get("attempts", 1) - 1), MAX_RETRY_BACKOFF)
+    return datetime.now() >= datetime.fromisoformat(entry["failed_at"]) + backoff
+
+
+def load_hash_cache():
+    if HASH_CACHE_FILE.exists():
+        try:
+            with open(HASH_CACHE_FILE, "r") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"⚠️ Could not load hash cache: {e}")
+    return {}
+
+
+def save_hash_cache(cache):
+    with open(HASH_CACHE_FILE, "w") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+
+
+def compute_hashes(thumbnails):
+    """
+    Hash thumbnails for the given {key: thumbnail_url} mapping.
+    Returns {key: {"phash": hex, "dhash": hex}}; keys already cached are not re-hashed,
+    and keys whose thumbnail could not be downloaded or decoded are left out.
+    """
+    cache = load_hash_cache()
+    missing = {k: url for k, url in thumbnails.items() if url and needs_hashing(cache.get(k), url)}
+
+    if missing:
+        THUMBNAIL_DIR.mkdir(exist_ok=True)
+        cached = sum(1 for entry in cache.values() if entry and "phash" in entry)
+        print(f"Hashing {len(missing)} new thumbnails ({cached} cached)...")
+
+        # Downloads are I/O bound, hashing is CPU bound
+        keys = list(missing)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            downloads = list(pool.map(download_thumbnail, keys, [missing[k] for k in keys]))
+
+        ready = []
+        for key, (path, retryable) in zip(keys, downloads):
+            if path:
+                ready.append((key, path))
+            else:
+                cache[key] = failure_entry(missing[key], retryable, cache.get(key))
+
+        with ProcessPoolExecutor() as pool:
+            results = pool.map(hash_thumbnail, [p for _, p in ready], chunksize=16)
+            for (key, path), result in zip(ready, results):
+                if result:
+                    cache[key] = {"phash": result[0], "dhash": result[1]}
+                else:
+                    # Possibly a truncated download; drop it so the retry fetches it again
+                    path.unlink(missing_ok=True)
+                    cache[key] = failure_entry(missing[key], True, cache.get(key))
+
+        save_hash_cache(cache)
+
+    return {k: cache[k] for k in thumbnails if "phash" in (cache.get(k) or {})}
+
+
+# --- DUPLICATE SEARCH ---
+
+def popcount64(values):
+    """Number of set bits in each element of a uint64 array."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    counts = _POPCOUNT_TABLE[values.view(np.uint8)]
+    return counts.reshape(-1, 8).sum(axis=1)
+
+
+def _band_masks(num_bands):
+    """Split 64 bits into num_bands contiguous (shift, width) bands."""
+    bounds = np.linspace(0, 64, num_bands + 1).astype(int)
+    return [(int(lo), int(hi - lo)) for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+
+def _flip_masks(width, radius):
+    """Every XOR mask of `width` bits with at most `radius` bits set."""
+    masks = [0]
+    for r in range(1, radius + 1):
+        for bits in combinations(range(width), r):
+            masks.append(sum(1 << b for b in bits))
+    return np.array(masks, dtype=np.uint64)
+
+
+def near_pairs(hashes, max_distance):
+    """
+    All index pairs (i < j) whose hashes differ in at most max_distance bits.
+
+    Multi-index hashing: with m bands, two hashes within max_distance bits are
+    within max_distance // m bits on at least one band, so each band only has to
+    be probed at that small radius via binary search over the sorted band values.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    n = len(hashes)
+    if n < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    # ~log2(n) bits per band keeps buckets at about one entry each
+    num_bands = int(np.clip(round(64 / np.log2(n)), 1, max_distance + 1))
+    radius = max_distance // num_bands
+    rows = np.arange(n)
+
+    found = []
+    for shift, width in _band_masks(num_bands):
+        band = (hashes >> np.uint64(shift)) & np.uint64((1 << width) - 1)
+        order = np.argsort(band, kind="stable")
+        sorted_band = band[order]
+
+        for flip in _flip_masks(width, radius):
+            probe = band ^ flip
+            lo = np.searchsorted(sorted_band, probe, side="left")
+            counts = np.searchsorted(sorted_band, probe, side="right") - lo
+            if not counts.any():
+                continue
+            # Expand each probe's [lo, hi) bucket into (query, match) rows
+            left = np.repeat(rows, counts)
+            starts = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+            right = order[starts + np.arange(len(left))]
+
+            keep = left < right
+            left, right = left[keep], right[keep]
+            keep = popcount64(hashes[left] ^ hashes[right]) <= max_distance
+            found.append(left[keep].astype(np.int64) * n + right[keep])
+
+    # The same pair can match on several bands
+    packed = np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.int64)
+    return packed // n, packed % n
+
+
+def find_near_duplicates(phashes, dhashes, phash_distance=PHASH_MAX_DISTANCE,
+                         dhash_distance=DHASH_MAX_DISTANCE):
+    """
+    Returns index pairs (i, j) whose pHash is within phash_distance bits and
+    whose dHash is within dhash_distance bits.
+    """
+    dhashes = np.asarray(dhashes, dtype=np.uint64)
+    left, right = near_pairs(phashes, phash_distance)
+    keep = popcount64(dhashes[left] ^ dhashes[right]) <= dhash_distance
+    return left[keep], right[keep]
+
+
+def group_pairs(n, left, right):
+    """Union-find the matched pairs into groups; returns lists of indices (size >= 2)."""
+    parent = list(range(n))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for a, b in zip(left.tolist(), right.tolist()):
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+
+    groups = {}
+    for i in range(n):
+        groups.setdefault(find(i), []).append(i)
+    return [g for g in groups.values() if len(g) > 1]
+
+
+def duplicate_groups(thumbnails, phash_distance=PHASH_MAX_DISTANCE,
+                     dhash_distance=DHASH_MAX_DISTANCE):
+    """
+    Find near-duplicate reels for a {key: thumbnail_url} mapping.
+    Returns a list of duplicate groups, each a sorted list of reel keys.
+    """
+    hashes = compute_hashes(thumbnails)
+    keys = sorted(hashes)
+    if not keys:
+        return []
+
+    phashes = [int(hashes[k]["phash"], 16) for k in keys]
+    dhashes = [int(hashes[k]["dhash"], 16) for k in keys]
+    left, right = find_near_duplicates(phashes, dhashes, phash_distance, dhash_distance)
+    return [sorted(keys[i] for i in group) for group in group_pairs(len(keys), left, right)]
+
+
+# --- BENCHMARK ---
+
+def _flip_bits(rng, values, max_flips):
+    """Flip up to max_flips random bits in each value."""
+    flips = rng.integers(0, max_flips + 1, size=len(values))
+    for k in range(max_flips):
+        bit = np.left_shift(np.uint64(1), rng.integers(0, 64, size=len(values)).astype(np.uint64))
+        values = np.where(flips > k, values ^ bit, values)
+    return values
+
+
+def _brute_force_groups(n, left, right):
+    """Connected components by BFS, independent of group_pairs' union-find."""
+    neighbours = [[] for _ in range(n)]
+    for a, b in zip(left.tolist(), right.tolist()):
+        neighbours[a].append(b)
+        neighbours[b].append(a)
+    seen, groups = set(), []
+    for start in range(n):
+        if start in seen or not neighbours[start]:
+            continue
+        queue, group = [start], set()
+        while queue:
+            i = queue.pop()
+            if i not in group:
+                group.add(i)
+                queue.extend(neighbours[i])
+        seen |= group
+        groups.append(group)
+    return groups
+
+
+def run_verify(trials=300, seed=0):
+    """Compare near_pairs and group_pairs against a brute-force all-pairs scan."""
+    rng = np.random.default_rng(seed)
+    print(f"Verifying duplicate search against brute force ({trials} trials)...")
+
+    for trial in range(trials):
+        n = int(rng.integers(0, 300))
+        max_distance = int(rng.integers(0, 20))
+        # A few clusters plus noise, so pairs exist at every distance
+        centers = rng.integers(0, 2**64, size=max(1, n // 10), dtype=np.uint64)
+        hashes = _flip_bits(rng, centers[rng.integers(0, len(centers), size=n)], 24)
+
+        left, right = near_pairs(hashes, max_distance)
+        expected_left, expected_right = np.triu_indices(n, 1)
+        keep = popcount64(hashes[expected_left] ^ hashes[expected_right]) <= max_distance
+        expected_left, expected_right = expected_left[keep], expected_right[keep]
+
+        got = set(zip(left.tolist(), right.tolist()))
+        expected = set(zip(expected_left.tolist(), expected_right.tolist()))
+        if got != expected:
+            print(f"❌ Trial {trial} (n={n}, distance={max_distance}): "
+                  f"{len(expected - got)} pairs missed, {len(got - expected)} extra")
+            return False
+
+        groups = {frozenset(g) for g in group_pairs(n, left, right)}
+        if groups != {frozenset(g) for g in _brute_force_groups(n, left, right)}:
+            print(f"❌ Trial {trial} (n={n}, distance={max_distance}): groups differ")
+            return False
+
+    print(f"✓ All {trials} trials match brute force.")
+    return True
+
+
+def run_benchmark(size, phash_distance, dhash_distance):
+    """Time the duplicate search on random hashes with planted near-duplicates."""
+    rng = np.random.default_rng(0)
+    phashes = rng.integers(0, 2**64, size=size, dtype=np.uint64)
+    dhashes = rng.integers(0, 2**64, size=size, dtype=np.uint64)
+
+    # Re-share ~5% of the reels with a few bits of re-encoding noise
+    planted = size // 20
+    src = rng.choice(size - planted, size=planted, replace=False)
+    phashes[size - planted:] = _flip_bits(rng, phashes[src], phash_distance)
+    dhashes[size - planted:] = _flip_bits(rng, dhashes[src], dhash_distance)
+
+    print(f"Benchmarking {size:,} hashes ({planted:,} planted duplicates)...")
+
+    start = time.perf_counter()
+    left, right = find_near_duplicates(phashes, dhashes, phash_distance, dhash_distance)
+    search_time = time.perf_counter() - start
+    groups = group_pairs(size, left, right)
+    total_time = time.perf_counter() - start
+
+    found = set(zip(left.tolist(), right.tolist()))
+    recalled = sum((min(s, d), max(s, d)) in found
+                   for s, d in zip(src.tolist(), range(size - planted, size)))
+
+    print(f"  Matched pairs:    {len(left):,}")
+    print(f"  Pair search:      {search_time:.3f}s")
+    print(f"  Search + groups:  {total_time:.3f}s")
+    print(f"  Duplicate groups: {len(groups):,}")
+    print(f"  Planted recalled: {recalled:,}/{planted:,}")
+
+
+def main():
+    args = parse_args()
+
+    if args.verify:
+        sys.exit(0 if run_verify() else 1)
+
+    if args.benchmark:
+        run_benchmark(args.size, args.phash_distance, args.dhash_distance)
+        return
+
+    if not THREAD_FILE.exists():
+        print(f"Error: {THREAD_FILE} not found.")
+        return
+
+    with open(THREAD_FILE, "r") as f:
+        messages = json.load(f).get("messages", [])
+
+    thumbnails = {reel_key(m): m.get("reel_thumbnail") for m in reel_messages(messages)
+                  if m.get("reel_thumbnail")}
+    groups = duplicate_groups(thumbnails, args.phash_distance, args.dhash_distance)
+
+    print(f"\nFound {len(groups)} duplicate groups among {len(thumbnails)} reels:")
+    for group in groups:
+        print(f"  • {', '.join(group)}")
+
+
+if __name__ == "__main__":
+    main()
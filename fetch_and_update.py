@@ -4,6 +4,7 @@ import sys
 from pathlib import Path
 from datetime import datetime
 import subprocess
+import hashlib
 
 # Paths - use relative paths for GitHub Actions compatibility
 SCRIPT_DIR = Path(__file__).parent.resolve()
@@ -16,6 +17,20 @@ REELS_DATA_JS = MESSAGES_DIR / "reels_data.js"
 PYTHON_BIN = sys.executable
 
 
+def reel_key(msg):
+    """Stable per-reel key: the reel_code, or a digest of the URL."""
+    if msg.get("reel_code"):
+        return msg["reel_code"]
+    return hashlib.sha1(msg["reel_url"].encode("utf-8")).hexdigest()[:16]
+
+
+def reel_messages(messages):
+    """Returns the messages that belong in the catalog."""
+    # Check if it's a reel based on keys produced by download_dm.py
+    return [m for m in messages
+            if m.get("item_type") in ("clip", "reel_share", "xma_media_share") and m.get("reel_url")]
+
+
 def run_download_script():
     """Runs the existing download_dm.py script to fetch latest messages."""
     print("--- Fetching New Messages via instagrapi ---")
@@ -42,18 +57,19 @@ def update_catalog():
         messages = data.get("messages", [])
 
     reels = []
-    for msg in messages:
-        # Check if it's a reel based on keys produced by download_dm.py
-        if msg.get("item_type") in ("clip", "reel_share", "xma_media_share") and msg.get("reel_url"):
-            user_id = msg.get("user_id")
-            user_name = user_map.get(user_id, f"User {user_id}")
-            
-            reels.append({
-                "url": msg.get("reel_url"),
-                "thumbnail": msg.get("reel_thumbnail"),
-                "user": user_name,
-                "timestamp": msg.get("timestamp")
-            })
+    for msg in reel_messages(messages):
+        user_id = msg.get("user_id")
+        user_name = user_map.get(user_id, f"User {user_id}")
+        
+        reels.append({
+            "key": reel_key(msg),
+            "url": msg.get("reel_url"),
+            "thumbnail": msg.get("reel_thumbnail"),
+            "user": user_name,
+            "timestamp": msg.get("timestamp")
+        })
+
+    mark_duplicates(reels)
 
     # Sort descending
     reels.sort(key=lambda x: x['timestamp'], reverse=True)
@@ -65,6 +81,37 @@ def update_catalog():
     
     print(f"✓ Updated catalog with {len(reels)} reels.")
 
+def mark_duplicates(reels):
+    """Tags reshared reels with a shared "duplicate_group" id."""
+    print("--- Detecting Duplicate Reels ---")
+    try:
+        from dedupe_reels import duplicate_groups
+    except ImportError as e:
+        print(f"⚠️ Skipping duplicate detection: {e}")
+        return
+
+    thumbnails = {r["key"]: r["thumbnail"] for r in reels if r["thumbnail"]}
+    try:
+        groups = duplicate_groups(thumbnails)
+    except Exception as e:
+        print(f"⚠️ Skipping duplicate detection: {e}")
+        return
+
+    # The same reel_code shared more than once is a duplicate too
+    grouped = {key for group in groups for key in group}
+    counts = {}
+    for reel in reels:
+        counts[reel["key"]] = counts.get(reel["key"], 0) + 1
+    groups += [[key] for key, count in counts.items() if count > 1 and key not in grouped]
+
+    # Id each group by its smallest key so ids stay stable across runs
+    group_of = {key: min(group) for group in groups for key in group}
+    for reel in reels:
+        if reel["key"] in group_of:
+            reel["duplicate_group"] = group_of[reel["key"]]
+
+    print(f"✓ Found {len(groups)} duplicate groups.")
+
 def build_bundle():
     """Runs the bundle script."""
     print("--- Generating Shareable Bundle ---")